@@ -1,16 +1,28 @@
+import hashlib
+import io
 import logging
 import os
-from typing import Dict
-
-import google_auth_httplib2
-import httplib2
+import threading
+import time
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from typing import Dict, NamedTuple, Optional
+
+import httpx
+import orjson
 import requests
+from cachetools import LRUCache, TTLCache
 from dotenv import load_dotenv
-from flask import Flask, Response, abort, request
+from flask import Flask, Response, abort, request, send_file
+from flask.json.provider import DefaultJSONProvider
+from gevent import monkey as gevent_monkey
+from gevent.threadpool import ThreadPool
+from google.auth.transport.requests import Request as GoogleAuthRequest
 from google.oauth2 import service_account
-from googleapiclient.discovery import build
 from jinja2 import Template
-from weasyprint import HTML
+from weasyprint import CSS, HTML
+from weasyprint.text.fonts import FontConfiguration
 
 # --- LOGGING CONFIGURATION ---
 logging.basicConfig(
@@ -20,7 +32,19 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+
+class OrjsonProvider(DefaultJSONProvider):
+    """Parse webhook payloads and serialize responses with orjson."""
+
+    def dumps(self, obj, **kwargs) -> str:
+        return orjson.dumps(obj, default=self.default).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+
 app = Flask(__name__)
+app.json = OrjsonProvider(app)
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -34,37 +58,262 @@ TABLE_ID = os.getenv("TABLE_ID")
 
 GOOGLE_CREDENTIALS_FILE = os.path.join(BASE_DIR, "service_account.json")
 GOOGLE_DRIVE_PARENT_FOLDER_ID = os.getenv("GOOGLE_DRIVE_PARENT_FOLDER_ID")
+# Set when the parent folder is already shared "anyone with the link" so new
+# folders inherit public read access and the extra permissions call is skipped
+GOOGLE_DRIVE_PARENT_IS_PUBLIC = os.getenv(
+    "GOOGLE_DRIVE_PARENT_IS_PUBLIC", "false"
+).lower() in ("1", "true", "yes")
+
+# Opt in to acking webhooks with 202 and processing rows on a background pool.
+# Only enable this on hosts that keep worker threads running between requests,
+# such as the gunicorn setup in gunicorn.conf.py. PythonAnywhere web apps do not,
+# so by default the row is processed inside the request and a failure is
+# answered with a 500 that Baserow retries. In background mode a failed job is
+# retried in-process WEBHOOK_ATTEMPTS times and then only logged, because
+# Baserow never redelivers a webhook it received a 2xx for.
+WEBHOOK_BACKGROUND = os.getenv("WEBHOOK_BACKGROUND", "false").lower() in (
+    "1",
+    "true",
+    "yes",
+)
+WEBHOOK_ATTEMPTS = int(os.getenv("WEBHOOK_ATTEMPTS", "3"))
+WEBHOOK_RETRY_DELAY = 5
 
 TEMPLATE_FILE = os.path.join(BASE_DIR, "profile_template.html")
+STYLESHEET_FILE = os.path.join(BASE_DIR, "profile_template.css")
 API_ENDPOINT = os.getenv(
     "API_ENDPOINT", "https://localhost:8000"
 )  # Defaults to localhost when testing
 
-# Set up Google Drive Client
+# Compile the profile template once at import rather than on every PDF request
+with open(TEMPLATE_FILE, "rb") as file:
+    template_source = file.read()
+PROFILE_TEMPLATE = Template(template_source.decode("utf-8"))
+
+# Share font lookups and the parsed stylesheet across every PDF render
+FONT_CONFIG = FontConfiguration()
+PROFILE_STYLESHEETS = [CSS(filename=STYLESHEET_FILE, font_config=FONT_CONFIG)]
+
+# Fingerprint of the layout, folded into every PDF digest so a template or
+# stylesheet change invalidates cached PDFs and browser ETags
+with open(STYLESHEET_FILE, "rb") as file:
+    LAYOUT_DIGEST = hashlib.sha256(template_source + file.read()).digest()
+
+# The profile uses system fonts only, so keep WeasyPrint embedding glyph subsets
+# without hinting tables rather than whole font files
+PDF_OPTIONS = {
+    "stylesheets": PROFILE_STYLESHEETS,
+    "font_config": FONT_CONFIG,
+    "optimize_images": True,
+    "full_fonts": False,
+    "hinting": False,
+}
+
+
+class CachedPdf(NamedTuple):
+    digest: str
+    upstream_etag: Optional[str]
+    last_modified: Optional[str]
+    filename: str
+    pdf_bytes: bytes
+
+
+# Rendered PDFs keyed by student ID, revalidated against Baserow on each request.
+# Bounded by total PDF bytes rather than entries, since embedded photos make
+# sizes vary widely
+PDF_CACHE_MAX_BYTES = int(os.getenv("PDF_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+PDF_CACHE: LRUCache = LRUCache(
+    maxsize=PDF_CACHE_MAX_BYTES, getsizeof=lambda entry: len(entry.pdf_bytes)
+)
+PDF_CACHE_LOCK = threading.Lock()
+
+# Native thread for WeasyPrint renders under gevent, created on first use. One
+# thread is enough for CPU-bound renders and keeps FONT_CONFIG single-threaded
+RENDER_POOL: Optional[ThreadPool] = None
+
+# Background pool for webhook work when WEBHOOK_BACKGROUND is enabled
+WEBHOOK_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_WORKERS", "8")),
+    thread_name_prefix="webhook",
+)
+# Separate pool for Drive calls that overlap a webhook's Baserow update, so they
+# never queue behind the webhook jobs that are waiting on them
+DRIVE_EXECUTOR = ThreadPoolExecutor(
+    max_workers=int(os.getenv("WEBHOOK_WORKERS", "8")),
+    thread_name_prefix="drive",
+)
+
+# Rows seen in the last hour, keyed by (table_id, row_id), so redelivered
+# webhooks are answered without touching Drive or Baserow again. The cache lives
+# in this process, so the app must run as a single worker process (the default in
+# gunicorn.conf.py). Multiple workers would need a shared store such as Redis
+# SET NX EX instead
+SEEN_ROWS: TTLCache = TTLCache(maxsize=10_000, ttl=3600)
+SEEN_ROWS_LOCK = threading.Lock()
+
+# Folders created for rows whose processing has not finished yet, so a retry of
+# a failed job reuses its folder instead of leaving an orphan behind. Guarded by
+# SEEN_ROWS_LOCK
+CREATED_FOLDERS: TTLCache = TTLCache(maxsize=10_000, ttl=86_400)
+
+# Connect and read timeouts for Baserow and Drive calls, in seconds
+HTTP_TIMEOUT = httpx.Timeout(10.0, connect=3.0)
+HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# Built once at import, requests only fill in the table and row IDs
+BASEROW_HEADERS = {
+    "Authorization": f"Token {BASEROW_TOKEN}",
+    "Content-Type": "application/json",
+}
+BASEROW_ROW_URL = f"{BASEROW_API_URL}%s/%d/?user_field_names=true"
+PROFILE_URL = f"{API_ENDPOINT}/student-details/%d"
+
+
+class RetryTransport(httpx.HTTPTransport):
+    """Retry idempotent requests on 429/5xx responses with exponential backoff."""
+
+    RETRY_METHODS = frozenset({"GET", "PATCH"})
+    RETRY_STATUSES = frozenset({429, 500, 502, 503, 504})
+
+    def __init__(self, *args, status_retries=3, backoff_factor=0.3, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.status_retries = status_retries
+        self.backoff_factor = backoff_factor
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        response = super().handle_request(request)
+        if request.method not in self.RETRY_METHODS:
+            return response
+
+        for attempt in range(self.status_retries):
+            if response.status_code not in self.RETRY_STATUSES:
+                break
+            delay = self.backoff_factor * 2**attempt
+            retry_after = response.headers.get("Retry-After", "")
+            if retry_after.isdigit():
+                delay = max(delay, min(int(retry_after), 10))
+
+            response.close()
+            time.sleep(delay)
+            response = super().handle_request(request)
+
+        return response
+
+
+# Set up a shared HTTP/2 Baserow client so concurrent requests multiplex over one
+# keep-alive connection. A custom transport stops httpx reading proxy settings
+# from the environment, so pass the environment's HTTPS proxy explicitly
+BASEROW = httpx.Client(
+    headers=BASEROW_HEADERS,
+    timeout=HTTP_TIMEOUT,
+    transport=RetryTransport(
+        http2=True,
+        proxy=urllib.request.getproxies().get("https"),
+        limits=HTTP_LIMITS,
+        retries=3,
+    ),
+)
+
+# Set up a shared HTTP/2 Google Drive REST client, explicitly routed through the
+# PythonAnywhere proxy, so folder calls multiplex over one keep-alive connection
+DRIVE_API_URL = "https://www.googleapis.com/drive/v3"
+DRIVE_PROXY = "http://proxy.server:3128"
+
+DRIVE = httpx.Client(
+    base_url=DRIVE_API_URL,
+    headers={"Content-Type": "application/json"},
+    timeout=HTTP_TIMEOUT,
+    transport=httpx.HTTPTransport(
+        http2=True, proxy=DRIVE_PROXY, limits=HTTP_LIMITS, retries=3
+    ),
+)
+
+# Request bodies that never change between webhooks. The permission body is
+# pre-encoded, and bytes cannot be mutated by accident
+DRIVE_FOLDER_TEMPLATE = {
+    "mimeType": "application/vnd.google-apps.folder",
+    "parents": [GOOGLE_DRIVE_PARENT_FOLDER_ID],
+}
+DRIVE_PUBLIC_READER_PERMISSION = orjson.dumps({"type": "anyone", "role": "reader"})
+
+# google-auth refreshes tokens through requests, give it its own proxied session
+TOKEN_SESSION = requests.Session()
+TOKEN_SESSION.proxies.update({"https": DRIVE_PROXY})
+TOKEN_REQUEST = GoogleAuthRequest(session=TOKEN_SESSION)
+
+DRIVE_TOKEN_LOCK = threading.RLock()
+# Refresh the access token in the background this long before it expires
+DRIVE_TOKEN_REFRESH_MARGIN = timedelta(minutes=5)
+DRIVE_TOKEN_CHECK_INTERVAL = 60
+
+# Load the Google service account credentials
+creds = None
 try:
     creds = service_account.Credentials.from_service_account_file(
         GOOGLE_CREDENTIALS_FILE, scopes=["https://www.googleapis.com/auth/drive"]
     )
 
-    # Explicitly define the PythonAnywhere proxy
-    proxy_info = httplib2.ProxyInfo(
-        proxy_type=httplib2.socks.PROXY_TYPE_HTTP,
-        proxy_host="proxy.server",
-        proxy_port=3128,
+    logger.info("Google Drive credentials loaded successfully with Proxy routing.")
+except Exception as e:
+    logger.error(f"Failed to load Google Drive credentials: {e}", exc_info=True)
+
+
+def drive_token() -> str:
+    # The background refresher keeps this warm, refreshing inline is the fallback
+    with DRIVE_TOKEN_LOCK:
+        if not creds.valid:
+            creds.refresh(TOKEN_REQUEST)
+        return creds.token
+
+
+def refresh_drive_token_forever():
+    while True:
+        try:
+            with DRIVE_TOKEN_LOCK:
+                # google-auth stores expiry as naive UTC
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                expiring = creds.expiry is None or (
+                    creds.expiry - now < DRIVE_TOKEN_REFRESH_MARGIN
+                )
+                if expiring:
+                    creds.refresh(TOKEN_REQUEST)
+                    logger.info("Google Drive access token refreshed.")
+        except Exception as e:
+            logger.warning(f"Background Drive token refresh failed: {e}")
+
+        time.sleep(DRIVE_TOKEN_CHECK_INTERVAL)
+
+
+# Keep the webhook path off the OAuth token endpoint
+if creds is not None:
+    threading.Thread(
+        target=refresh_drive_token_forever, name="drive-token-refresher", daemon=True
+    ).start()
+
+
+def drive_post(path: str, body: bytes, fields: str) -> Dict:
+    response = DRIVE.post(
+        path,
+        params={"fields": fields},
+        content=body,
+        headers={"Authorization": f"Bearer {drive_token()}"},
     )
+    response.raise_for_status()
+    return orjson.loads(response.content)
 
-    # Attach the proxy to an httplib2 instance
-    http_instance = httplib2.Http(proxy_info=proxy_info)
-
-    # Bind your credentials to the proxied http instance
-    authed_http = google_auth_httplib2.AuthorizedHttp(creds, http=http_instance)
 
-    # Pass the proxied http to the build function
-    drive_service = build("drive", "v3", http=authed_http)
-
-    logger.info("Google Drive service initialized successfully with Proxy routing.")
-except Exception as e:
-    logger.error(f"Failed to initialize Google Drive service: {e}", exc_info=True)
+def wait_for_public_permission(permission_future, folder_id: str):
+    try:
+        permission_future.result()
+    except Exception as e:
+        # The grant is safe to repeat, so give it one more go before failing the row
+        logger.warning(f"Permission grant for folder {folder_id} failed, retrying: {e}")
+        drive_post(
+            f"/files/{folder_id}/permissions",
+            DRIVE_PUBLIC_READER_PERMISSION,
+            fields="id",
+        )
+    logger.info("Permissions updated successfully.")
 
 
 # --- Student Details PDF Generator ---
@@ -72,38 +321,102 @@ except Exception as e:
 def generate_sponsor_pdf(student_id):
     logger.info(f"PDF generation requested for student ID: {student_id}")
 
-    headers = {
-        "Authorization": f"Token {BASEROW_TOKEN}",
-        "Content-Type": "application/json",
-    }
+    with PDF_CACHE_LOCK:
+        cached = PDF_CACHE.get(student_id)
 
-    response = requests.get(
-        f"{BASEROW_API_URL}{TABLE_ID}/{student_id}/?user_field_names=true",
-        headers=headers,
+    # Revalidate a cached PDF with Baserow rather than downloading the record again
+    conditional_headers = {}
+    if cached:
+        if cached.upstream_etag:
+            conditional_headers["If-None-Match"] = cached.upstream_etag
+        if cached.last_modified:
+            conditional_headers["If-Modified-Since"] = cached.last_modified
+
+    response = BASEROW.get(
+        BASEROW_ROW_URL % (TABLE_ID, student_id),
+        headers=conditional_headers,
     )
 
+    if cached and response.status_code == 304:
+        logger.info(f"Student {student_id} unchanged in Baserow, serving cached PDF.")
+        return pdf_response(cached)
+
     if response.status_code != 200:
         logger.warning(
             f"Failed to fetch student {student_id} from Baserow. Status: {response.status_code}"
         )
         abort(404, description="Student record not found")
 
-    student_data = response.json()
+    # Key the rendered PDF on the layout and the record's content so unchanged
+    # records skip WeasyPrint
+    digest = hashlib.sha256(LAYOUT_DIGEST + response.content).hexdigest()
+
+    if cached and cached.digest == digest:
+        logger.info(f"Serving cached PDF for student ID: {student_id}")
+        return pdf_response(cached)
+
+    student_data = orjson.loads(response.content)
+    entry = CachedPdf(
+        digest=digest,
+        upstream_etag=response.headers.get("ETag"),
+        last_modified=response.headers.get("Last-Modified"),
+        filename=f"{student_data.get('Full Name', 'Student')}_{student_id}.pdf",
+        pdf_bytes=render_off_event_loop(student_data),
+    )
+    # A single PDF larger than the whole cache is served but not kept
+    if len(entry.pdf_bytes) <= PDF_CACHE_MAX_BYTES:
+        with PDF_CACHE_LOCK:
+            PDF_CACHE[student_id] = entry
 
-    with open(TEMPLATE_FILE, "r", encoding="utf-8") as file:
-        html_template = file.read()
+    logger.info(f"Successfully generated PDF for student ID: {student_id}")
+    return pdf_response(entry)
 
-    template = Template(html_template)
-    rendered_html = template.render(student=student_data)
-    pdf_bytes = HTML(string=rendered_html).write_pdf()
 
-    logger.info(f"Successfully generated PDF for student ID: {student_id}")
-    return Response(
-        pdf_bytes,
+def pdf_response(entry: CachedPdf) -> Response:
+    # Stream the cached bytes through the WSGI file wrapper instead of one write
+    response = send_file(
+        io.BytesIO(entry.pdf_bytes),
         mimetype="application/pdf",
-        headers={
-            "Content-Disposition": f'inline; filename="{student_data.get("Full Name", "Student")}_{student_id}.pdf"'
-        },
+        as_attachment=False,
+        download_name=entry.filename,
+        etag=entry.digest,
+        conditional=False,
+    )
+
+    # An explicit length avoids chunked transfer and lets clients show progress
+    size = len(entry.pdf_bytes)
+    response.content_length = size
+
+    # Student profiles may be cached by the sponsor's browser, never by proxies
+    response.cache_control.no_cache = None
+    response.cache_control.private = True
+    response.cache_control.max_age = 300
+
+    return response.make_conditional(request, accept_ranges=True, complete_length=size)
+
+
+def render_off_event_loop(student_data: Dict) -> bytes:
+    # Under gunicorn's gevent workers a render would block the event loop and stall
+    # every webhook in the worker, so it runs on a native thread instead
+    global RENDER_POOL
+    if not gevent_monkey.is_module_patched("threading"):
+        return render_profile_pdf(student_data)
+
+    if RENDER_POOL is None:
+        RENDER_POOL = ThreadPool(1)
+    return RENDER_POOL.apply(render_profile_pdf, (student_data,))
+
+
+def render_profile_pdf(student_data: Dict) -> bytes:
+    # Stream the template as UTF-8 straight into a buffer instead of one large str
+    html_buffer = io.BytesIO()
+    stream = PROFILE_TEMPLATE.stream(student=student_data)
+    stream.enable_buffering(64)
+    stream.dump(html_buffer, encoding="utf-8")
+    html_buffer.seek(0)
+
+    return HTML(file_obj=html_buffer, base_url=BASE_DIR, encoding="utf-8").write_pdf(
+        **PDF_OPTIONS
     )
 
 
@@ -126,7 +439,15 @@ def handle_new_record():
 
         # Extract data
         student_data: Dict = items[0]
-        row_id = student_data.get("id")
+        # Row URLs are formatted with %d, so reject non-integer IDs before Drive work
+        try:
+            row_id = int(student_data.get("id"))
+        except (TypeError, ValueError):
+            logger.warning(
+                f"Webhook row ID is not an integer: {student_data.get('id')!r}"
+            )
+            return {"status": "error", "reason": "Row ID must be an integer"}
+        student_data["id"] = row_id
 
         if row_id == 0:
             logger.info("Webhook test payload (ID 0) received and ignored.")
@@ -135,63 +456,151 @@ def handle_new_record():
                 "reason": "Row ID invalid/Webhook test successful, your pick.",
             }
 
-        student_name = student_data.get("Full Name", "Unknown")
+        # Replayed or re-imported rows already have a folder, nothing to do
+        if student_data.get("Google Drive Link"):
+            logger.info(f"Row {row_id} already has a Google Drive link, skipping.")
+            return {"status": "skipped", "reason": "already_linked"}
+
         table_id = payload.get("table_id")
 
-        logger.info(f"Processing new record: {student_name} (ID: {row_id})")
+        # Drop redeliveries of a row that is in progress or was recently processed
+        row_key = (table_id, row_id)
+        with SEEN_ROWS_LOCK:
+            duplicate = row_key in SEEN_ROWS
+            SEEN_ROWS[row_key] = True
+
+        if duplicate:
+            logger.info(f"Duplicate webhook for row {row_id} ignored.")
+            return {"status": "duplicate", "reason": "Row already processed"}
+
+        if WEBHOOK_BACKGROUND:
+            # Ack Baserow straight away, Drive and Baserow updates run in the background
+            WEBHOOK_EXECUTOR.submit(
+                process_new_record_in_background, table_id, student_data
+            )
+            logger.info(f"Queued new record {row_id} for processing.")
+            return {"status": "accepted", "row_id": row_id}, 202
+
+        try:
+            return process_new_record(table_id, student_data)
+        except Exception as e:
+            logger.error(f"CRITICAL ERROR processing row {row_id}: {e}", exc_info=True)
+
+            # Forget the row so Baserow's retry of this failed delivery can go through
+            with SEEN_ROWS_LOCK:
+                SEEN_ROWS.pop(row_key, None)
+
+            # A non-2xx response makes Baserow retry the delivery
+            return {"status": "error", "reason": str(e)}, 500
+
+    except Exception as e:
+        # exc_info=True prints the full traceback to the logs so you can find the exact line
+        logger.error(f"CRITICAL ERROR in webhook: {str(e)}", exc_info=True)
+        return {"status": "error", "reason": str(e)}
+
+
+def process_new_record_in_background(table_id, student_data: Dict):
+    row_id = student_data.get("id")
+    for attempt in range(1, WEBHOOK_ATTEMPTS + 1):
+        try:
+            process_new_record(table_id, student_data)
+            return
+        except Exception as e:
+            logger.error(
+                f"CRITICAL ERROR processing row {row_id} "
+                f"(attempt {attempt}/{WEBHOOK_ATTEMPTS}): {e}",
+                exc_info=True,
+            )
+            if attempt < WEBHOOK_ATTEMPTS:
+                time.sleep(WEBHOOK_RETRY_DELAY * attempt)
+
+    # Baserow will not redeliver, so leave the row free for a manual replay
+    logger.error(f"Giving up on row {row_id}, replay its webhook once Drive is back.")
+    with SEEN_ROWS_LOCK:
+        SEEN_ROWS.pop((table_id, row_id), None)
+
+
+def process_new_record(table_id, student_data: Dict) -> Dict:
+    row_id = student_data.get("id")
+    row_key = (table_id, row_id)
+    student_name = student_data.get("Full Name", "Unknown")
+
+    # Build the Baserow URLs up front so a formatting error cannot strand a new
+    # folder or an uncollected permission grant
+    profile_link = PROFILE_URL % row_id
+    update_url = BASEROW_ROW_URL % (table_id, row_id)
 
+    logger.info(f"Processing new record: {student_name} (ID: {row_id})")
+
+    folder_name = f"{row_id} - {student_name}"
+    with SEEN_ROWS_LOCK:
+        folder = CREATED_FOLDERS.get(row_key)
+
+    if folder:
+        logger.info(f"Reusing folder created by an earlier attempt for {row_id}.")
+    else:
         # Create the Google Drive Folder
         logger.info(f"Attempting to create Google Drive folder for {student_name}...")
-        folder_name = f"{row_id} - {student_name}"
-        folder_metadata = {
-            "name": folder_name,
-            "mimeType": "application/vnd.google-apps.folder",
-            "parents": [GOOGLE_DRIVE_PARENT_FOLDER_ID],
-        }
-
-        folder = (
-            drive_service.files()
-            .create(body=folder_metadata, fields="id, webViewLink")
-            .execute()
-        )
-        folder_id = folder.get("id")
-        folder_link = folder.get("webViewLink")
-        logger.info(f"Folder created successfully. Link: {folder_link}")
+        folder_metadata = {**DRIVE_FOLDER_TEMPLATE, "name": folder_name}
 
+        folder = drive_post(
+            "/files", orjson.dumps(folder_metadata), fields="id,webViewLink"
+        )
+        with SEEN_ROWS_LOCK:
+            CREATED_FOLDERS[row_key] = folder
+
+    folder_id = folder.get("id")
+    folder_link = folder.get("webViewLink")
+    logger.info(f"Folder ready. Link: {folder_link}")
+
+    # The Baserow update only needs the folder link, so grant the public
+    # permission concurrently instead of waiting for it first
+    permission_future = None
+    if GOOGLE_DRIVE_PARENT_IS_PUBLIC:
+        logger.info("Parent folder is public, permissions are inherited.")
+    else:
         logger.info("Updating folder permissions to public read-only...")
-        permission_metadata = {"type": "anyone", "role": "reader"}
-        drive_service.permissions().create(
-            fileId=folder_id, body=permission_metadata, fields="id"
-        ).execute()
-        logger.info("Permissions updated successfully.")
-
-        # Form profile link
-        profile_link = f"{API_ENDPOINT}/student-details/{row_id}"
-
-        # Update Baserow
-        logger.info(f"Attempting to update Baserow table {table_id}, row {row_id}...")
-        headers = {
-            "Authorization": f"Token {BASEROW_TOKEN}",
-            "Content-Type": "application/json",
-        }
+        permission_future = DRIVE_EXECUTOR.submit(
+            drive_post,
+            f"/files/{folder_id}/permissions",
+            DRIVE_PUBLIC_READER_PERMISSION,
+            fields="id",
+        )
 
-        update_url = f"{BASEROW_API_URL}{table_id}/{row_id}/?user_field_names=true"
-        update_data = {"Google Drive Link": folder_link, "Profile": profile_link}
+    # Update Baserow
+    logger.info(f"Attempting to update Baserow table {table_id}, row {row_id}...")
+    update_data = {"Google Drive Link": folder_link, "Profile": profile_link}
 
-        response = requests.patch(update_url, headers=headers, json=update_data)
+    permission_error = None
+    try:
+        response = BASEROW.patch(update_url, content=orjson.dumps(update_data))
 
         # If Baserow rejects the update, log exactly why before crashing
-        if not response.ok:
+        if not response.is_success:
             logger.error(
                 f"Baserow Update Failed! Status: {response.status_code}, Response Data: {response.text}"
             )
 
         response.raise_for_status()
 
-        logger.info(f"--- Successfully processed and updated student {row_id} ---")
-        return {"status": "success", "folder_name": folder_name, "link_added": True}
-
-    except Exception as e:
-        # exc_info=True prints the full traceback to the logs so you can find the exact line
-        logger.error(f"CRITICAL ERROR in webhook: {str(e)}", exc_info=True)
-        return {"status": "error", "reason": str(e)}
+    finally:
+        # Collect the grant even if the Baserow update failed, so a folder that
+        # never became public is always logged
+        if permission_future is not None:
+            try:
+                wait_for_public_permission(permission_future, folder_id)
+            except Exception as e:
+                logger.error(
+                    f"Folder {folder_id} was not made public: {e}", exc_info=True
+                )
+                permission_error = e
+
+    # Fail the job so the retry grants the permission on the reused folder
+    if permission_error is not None:
+        raise permission_error
+
+    with SEEN_ROWS_LOCK:
+        CREATED_FOLDERS.pop(row_key, None)
+
+    logger.info(f"--- Successfully processed and updated student {row_id} ---")
+    return {"status": "success", "folder_name": folder_name, "link_added": True}
@@ -0,0 +1,20 @@
+import os
+
+# Almost all webhook time is spent waiting on Baserow and Google Drive, so gevent
+# workers let one process overlap hundreds of those socket waits. The gevent
+# worker monkey-patches the standard library before app.py is imported.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "gevent")
+
+# A single worker process by default: app.py deduplicates webhook deliveries in
+# memory, so a redelivery landing on a second worker would create a second Drive
+# folder. gevent connections supply the concurrency instead of extra processes
+workers = int(os.getenv("GUNICORN_WORKERS", "1"))
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "500"))
+
+# WeasyPrint renders are CPU-bound, so app.py runs them on a gevent native
+# threadpool rather than in the event loop. The loop keeps serving webhooks, PDF
+# cache hits and background jobs while a render is in progress.
+timeout = int(os.getenv("GUNICORN_TIMEOUT", "60"))
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+wsgi_app = "app:app"